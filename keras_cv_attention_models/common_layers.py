@@ -13,7 +13,8 @@ CONV_KERNEL_INITIALIZER = keras.initializers.VarianceScaling(scale=2.0, mode="fa
 @tf.keras.utils.register_keras_serializable(package="kecamCommon")
 def hard_swish(inputs):
     """ `out = xx * relu6(xx + 3) / 6`, arxiv: https://arxiv.org/abs/1905.02244 """
-    return inputs * tf.nn.relu6(inputs + 3) / 6
+    # Multiply by a constant instead of divide, keeps a plain add -> relu6 -> mul pattern for graph optimizers
+    return inputs * tf.nn.relu6(inputs + 3) * (1.0 / 6.0)
 
 
 @tf.keras.utils.register_keras_serializable(package="kecamCommon")
@@ -84,7 +85,10 @@ def layer_norm(inputs, epsilon=LAYER_NORM_EPSILON, name=None):
 def conv2d_no_bias(inputs, filters, kernel_size, strides=1, padding="VALID", use_bias=False, groups=1, use_torch_padding=True, name=None, **kwargs):
     """ Typical Conv2D with `use_bias` default as `False` and fixed padding """
     pad = max(kernel_size) // 2 if isinstance(kernel_size, (list, tuple)) else kernel_size // 2
-    if use_torch_padding and padding.upper() == "SAME" and pad != 0:
+    # TF "SAME" padding is symmetric and same with torch one only if strides == 1 with a square odd kernel, then skip the extra ZeroPadding2D
+    is_same_as_torch_padding = set(kernel_size if isinstance(kernel_size, (list, tuple)) else [kernel_size]) == {pad * 2 + 1}
+    is_same_as_torch_padding = is_same_as_torch_padding and strides in [1, (1, 1), [1, 1]] and kwargs.get("dilation_rate", 1) in [1, (1, 1), [1, 1]]
+    if use_torch_padding and padding.upper() == "SAME" and pad != 0 and not is_same_as_torch_padding:
         inputs = keras.layers.ZeroPadding2D(padding=pad, name=name and name + "pad")(inputs)
         padding = "VALID"
 
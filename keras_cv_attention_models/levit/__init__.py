@@ -84,6 +84,11 @@ Examples:
 >>> print({ii.name:ii.numpy().shape for ii in aa.weights})
 # {'multi_head_positional_embedding/positional_embedding:0': (49, 8)}
 
+>>> print(f"{aa.get_pos_bias().shape = }")  # Additive attention bias
+# aa.get_pos_bias().shape = TensorShape([8, 16, 49])
+
+>>> aa.cache_pos_bias()  # Inference only, precompute pos_bias once instead of gathering on every call. Call again after loading weights
+
 >>> plt.imshow(aa.bb_pos)
 """
 
@@ -1,3 +1,6 @@
+import math
+import functools
+import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import backend as K
@@ -14,45 +17,99 @@ PRETRAINED_DICT = {
 }
 
 
+@functools.lru_cache(maxsize=None)
+def resize_matrix_1d(source_size, target_size, method="nearest"):
+    """
+    [target_size, source_size] matrix, `resize_matrix_1d(ss, tt, method) @ inputs` is same with `tf.image.resize` on one axis.
+    Only `nearest` and `bilinear` supported, using `half_pixel_centers` same with TF2 `tf.image.resize`.
+    """
+    scale = np.float32(source_size) / np.float32(target_size)  # float32 same with TF kernel, float64 differs like 14 -> 23
+    target_pos = np.arange(target_size)
+    resize_matrix = np.zeros([target_size, source_size], dtype="float32")
+    if method == "nearest":
+        source_pos = np.floor((target_pos.astype("float32") + np.float32(0.5)) * scale).astype("int64")
+        resize_matrix[target_pos, np.minimum(source_pos, source_size - 1)] = 1
+    elif method == "bilinear":
+        source_pos = (target_pos + 0.5) * scale - 0.5
+        lerp = (source_pos - np.floor(source_pos)).astype("float32")
+        lower = np.maximum(np.floor(source_pos).astype("int64"), 0)
+        upper = np.minimum(np.ceil(source_pos).astype("int64"), source_size - 1)
+        np.add.at(resize_matrix, (target_pos, lower), 1 - lerp)
+        np.add.at(resize_matrix, (target_pos, upper), lerp)
+    else:
+        raise ValueError("Only nearest and bilinear supported, got method={}".format(method))
+    return resize_matrix
+
+
 @tf.keras.utils.register_keras_serializable(package="levit")
 class MultiHeadPositionalEmbedding(keras.layers.Layer):
     def __init__(self, **kwargs):
         super(MultiHeadPositionalEmbedding, self).__init__(**kwargs)
+        self._cached_pos_bias = None
 
     def build(self, input_shape, **kwargs):
         _, num_heads, qq_blocks, kk_blocks = input_shape
         self.bb = self.add_weight(name="positional_embedding", shape=(kk_blocks, num_heads), initializer="zeros", trainable=True)
-        strides = int(tf.math.ceil(tf.math.sqrt(float(kk_blocks / qq_blocks))))
-        q_blocks_h = q_blocks_w = int(tf.math.sqrt(float(qq_blocks)))
-        k_blocks_h = k_blocks_w = int(tf.math.sqrt(float(kk_blocks)))
-
-        x1, y1 = tf.meshgrid(range(q_blocks_h), range(q_blocks_w))
-        x2, y2 = tf.meshgrid(range(k_blocks_h), range(k_blocks_w))
-        aa = tf.concat([tf.reshape(x1, (-1, 1)), tf.reshape(y1, (-1, 1))], axis=-1)
-        bb = tf.concat([tf.reshape(x2, (-1, 1)), tf.reshape(y2, (-1, 1))], axis=-1)
+        strides = int(math.ceil(math.sqrt(float(kk_blocks / qq_blocks))))
+        q_blocks_h = q_blocks_w = int(math.sqrt(float(qq_blocks)))
+        k_blocks_h = k_blocks_w = int(math.sqrt(float(kk_blocks)))
+
+        # Index table only depends on input_shape, compute it once in numpy and store as a constant
+        x1, y1 = np.meshgrid(range(q_blocks_h), range(q_blocks_w))
+        x2, y2 = np.meshgrid(range(k_blocks_h), range(k_blocks_w))
+        aa = np.stack([x1.ravel(), y1.ravel()], axis=-1)
+        bb = np.stack([x2.ravel(), y2.ravel()], axis=-1)
         # print(f">>>> {aa.shape = }, {bb.shape = }") # aa.shape = (16, 2), bb.shape = (49, 2)
-        cc = [tf.math.abs(bb - ii * strides) for ii in aa]
-        self.bb_pos = tf.stack([ii[:, 0] + ii[:, 1] * k_blocks_h for ii in cc])
+        cc = np.abs(bb[None] - aa[:, None] * strides)  # [qq_blocks, kk_blocks, 2]
+        self.bb_pos = tf.constant(cc[:, :, 0] + cc[:, :, 1] * k_blocks_h, dtype=tf.int32)
         # print(f">>>> {self.bb_pos.shape = }")    # self.bb_pos.shape = (16, 49)
 
         super(MultiHeadPositionalEmbedding, self).build(input_shape)
 
-    def call(self, inputs, **kwargs):
-        pos_bias = tf.gather(self.bb, self.bb_pos)
-        pos_bias = tf.transpose(pos_bias, [2, 0, 1])
-        return inputs + pos_bias
+    def get_pos_bias(self):
+        """ Additive attention bias in shape `[num_heads, qq_blocks, kk_blocks]` """
+        # Transpose the small [kk_blocks, num_heads] table instead of the gathered [qq_blocks, kk_blocks, num_heads] one.
+        # Weight shape is kept as [kk_blocks, num_heads] for compatibility with saved weights.
+        return tf.gather(tf.transpose(self.bb), self.bb_pos, axis=1)
+
+    def cache_pos_bias(self, enable=True):
+        """
+        Precompute pos_bias once for inference, so it's captured as a constant instead of a gather on every call.
+        Cache is only refreshed by this layer's own `set_weights` / `load_resized_pos_emb`. Call `cache_pos_bias()` again
+        after any model level weight loading like `model.set_weights` / `model.load_weights`, or training.
+        """
+        # Cache in compute dtype, as bb is read as float32 outside `call` under mixed precision policy
+        self._cached_pos_bias = tf.cast(self.get_pos_bias(), self.compute_dtype) if enable else None
+
+    def set_weights(self, weights):
+        super(MultiHeadPositionalEmbedding, self).set_weights(weights)
+        if self._cached_pos_bias is not None:
+            self.cache_pos_bias()
+
+    def call(self, inputs, training=None, **kwargs):
+        if self._cached_pos_bias is not None and not training:
+            return inputs + self._cached_pos_bias
+        return inputs + self.get_pos_bias()
 
     def load_resized_pos_emb(self, source_layer, method="nearest"):
         if isinstance(source_layer, dict):
             source_bb = source_layer["positional_embedding:0"]  # weights
         else:
             source_bb = source_layer.bb  # layer
-        hh = ww = int(tf.math.sqrt(float(source_bb.shape[0])))
-        ss = tf.reshape(source_bb, (hh, ww, source_bb.shape[-1]))  # [hh, ww, num_heads]
-        target_hh = target_ww = int(tf.math.sqrt(float(self.bb.shape[0])))
-        tt = tf.image.resize(ss, [target_hh, target_ww], method=method)  # [target_hh, target_ww, num_heads]
+        hh = ww = int(math.sqrt(float(source_bb.shape[0])))
+        target_hh = target_ww = int(math.sqrt(float(self.bb.shape[0])))
+        if method in ["nearest", "bilinear"]:
+            # Cached resize matrices instead of building tf.image.resize ops for each layer
+            ss = np.reshape(np.array(source_bb), (hh, ww, source_bb.shape[-1]))  # [hh, ww, num_heads]
+            resize_hh, resize_ww = resize_matrix_1d(hh, target_hh, method), resize_matrix_1d(ww, target_ww, method)
+            tt = np.einsum("th,hwc,sw->tsc", resize_hh, ss, resize_ww)  # [target_hh, target_ww, num_heads]
+        else:
+            ss = tf.reshape(source_bb, (hh, ww, source_bb.shape[-1]))  # [hh, ww, num_heads]
+            tt = tf.image.resize(ss, [target_hh, target_ww], method=method)  # [target_hh, target_ww, num_heads]
         tt = tf.reshape(tt, (self.bb.shape))  # [target_hh * target_ww, num_heads]
         self.bb.assign(tt)
+        if self._cached_pos_bias is not None:
+            self.cache_pos_bias()
 
     def show_pos_emb(self, rows=1, base_size=2):
         import matplotlib.pyplot as plt
@@ -68,20 +125,34 @@ class MultiHeadPositionalEmbedding(keras.layers.Layer):
         return fig
 
 
+@tf.keras.utils.register_keras_serializable(package="levit")
+class MatMul(keras.layers.Layer):
+    """ `tf.matmul` as a keras layer, so inputs are autocast and dtype policy follows `model_surgery.convert_to_mixed_float16` """
+
+    def __init__(self, transpose_b=False, **kwargs):
+        super(MatMul, self).__init__(**kwargs)
+        self.transpose_b = transpose_b
+
+    def call(self, inputs, **kwargs):
+        return tf.matmul(inputs[0], inputs[1], transpose_b=self.transpose_b)
+
+    def get_config(self):
+        base_config = super(MatMul, self).get_config()
+        base_config.update({"transpose_b": self.transpose_b})
+        return base_config
+
+
 def scaled_dot_product_attention(qq, kk, vv, key_dim, attn_ratio, output_dim, activation="hard_swish", name=""):
     # qq, kk, vv: [batch, num_heads, blocks, key_dim]
-    FLOAT_DTYPE = tf.keras.mixed_precision.global_policy().compute_dtype
-    qk_scale = tf.math.sqrt(tf.cast(key_dim, FLOAT_DTYPE))
+    inv_qk_scale = 1.0 / (float(key_dim) ** 0.5)  # Python float, baked as a constant of the same dtype with attn
     # print(f"{qq.shape = }, {kk.shape = }")
-    # attn = tf.matmul(qq, kk, transpose_b=True) / qk_scale   # [batch, num_heads, q_blocks, k_blocks]
-    attn = keras.layers.Lambda(lambda xx: tf.matmul(xx[0], xx[1], transpose_b=True))([qq, kk]) / qk_scale
+    attn = MatMul(transpose_b=True, name=name and name + "qk_matmul")([qq, kk]) * inv_qk_scale  # [batch, num_heads, q_blocks, k_blocks]
     # print(f"{attn.shape = }")
     attn = MultiHeadPositionalEmbedding(name=name + "attn_pos")(attn)
     # attn = tf.nn.softmax(attn, axis=-1)
     attn = keras.layers.Softmax(axis=-1, name=name and name + "attention_scores")(attn)
 
-    # output = tf.matmul(attn, vv)    # [batch, num_heads, q_blocks, key_dim * attn_ratio]
-    output = keras.layers.Lambda(lambda xx: tf.matmul(xx[0], xx[1]))([attn, vv])
+    output = MatMul(name=name and name + "attn_matmul")([attn, vv])  # [batch, num_heads, q_blocks, key_dim * attn_ratio]
     output = tf.transpose(output, perm=[0, 2, 1, 3])  # [batch, q_blocks, num_heads, key_dim * attn_ratio]
     output = tf.reshape(output, [-1, output.shape[1], output.shape[2] * output.shape[3]])  # [batch, q_blocks, channel * attn_ratio]
     if activation:
@@ -99,21 +170,27 @@ def mhsa_with_multi_head_position(inputs, output_dim, num_heads, key_dim, attn_r
     qkv = keras.layers.Dense(qkv_dim, use_bias=False, name=name + "qkv")(inputs)
     qkv = batchnorm_with_activation(qkv, activation=None, name=name + "qkv_")
     qkv = tf.reshape(qkv, (-1, blocks, num_heads, qkv_dim // num_heads))
+    # Keeping [batch, blocks, num_heads, dim] layout needs tf.einsum, but TFOpLambda wrapped einsum loses its tensor inputs in
+    # model config, breaking model_from_json / load_model. tf.matmul batches on leading axes, so transpose packed qkv once here.
     qkv = tf.transpose(qkv, perm=[0, 2, 1, 3])
-    qq, kk, vv = tf.split(qkv, [key_dim, key_dim, key_dim * attn_ratio], axis=-1)
+    # Slicing on the packed last axis instead of tf.split, XLA can fuse slices into the following matmul operand loads
+    qq, kk, vv = qkv[:, :, :, :key_dim], qkv[:, :, :, key_dim : 2 * key_dim], qkv[:, :, :, 2 * key_dim :]
     return scaled_dot_product_attention(qq, kk, vv, key_dim, attn_ratio, output_dim=output_dim, activation=activation, name=name)
 
 
 def mhsa_with_multi_head_position_and_strides(inputs, output_dim, num_heads, key_dim, attn_ratio=2, strides=1, activation="hard_swish", name=""):
+    if strides == 1:
+        # query and key / value are projected from the same inputs, use a single fused qkv Dense + BatchNormalization
+        return mhsa_with_multi_head_position(inputs, output_dim, num_heads, key_dim, attn_ratio, activation=activation, name=name)
+
     _, blocks, channel = inputs.shape
     embed_dim = key_dim * num_heads
 
-    if strides != 1:
-        width = int(tf.sqrt(float(blocks)))
-        qq = tf.reshape(inputs, (-1, width, width, channel))[:, ::strides, ::strides, :]
-        qq = tf.reshape(qq, [-1, qq.shape[1] * qq.shape[2], channel])
-    else:
-        qq = inputs
+    width = int(math.sqrt(float(blocks)))
+    # Same with `tf.reshape(inputs, (-1, width, width, channel))[:, ::strides, ::strides, :]`, as a single constant index gather on tokens
+    strided_idx = np.arange(width)[::strides]
+    strided_idx = (strided_idx[:, None] * width + strided_idx[None]).ravel()
+    qq = tf.gather(inputs, strided_idx, axis=1)
     qq = keras.layers.Dense(embed_dim, use_bias=False, name=name + "q")(qq)
     qq = batchnorm_with_activation(qq, activation=None, name=name + "q_")
     qq = tf.reshape(qq, [-1, qq.shape[1], num_heads, key_dim])
@@ -124,7 +201,7 @@ def mhsa_with_multi_head_position_and_strides(inputs, output_dim, num_heads, key
     kv = batchnorm_with_activation(kv, activation=None, name=name + "kv_")
     kv = tf.reshape(kv, (-1, blocks, num_heads, kv_dim // num_heads))
     kv = tf.transpose(kv, perm=[0, 2, 1, 3])
-    kk, vv = tf.split(kv, [key_dim, key_dim * attn_ratio], axis=-1)
+    kk, vv = kv[:, :, :, :key_dim], kv[:, :, :, key_dim:]
     return scaled_dot_product_attention(qq, kk, vv, key_dim, attn_ratio, output_dim=output_dim, activation=activation, name=name)
 
 
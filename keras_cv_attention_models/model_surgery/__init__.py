@@ -2,13 +2,20 @@ from keras_cv_attention_models.model_surgery.model_surgery import (
     SAMModel,
     DropConnect,
     add_l2_regularizer_2_model,
+    apply_surgeries,
     change_model_input_shape,
     convert_gelu_and_extract_patches_for_tflite,
     convert_groups_conv2d_2_split_conv2d,
     convert_to_mixed_float16,
+    convert_to_int8_tflite,
     convert_mixed_float16_to_float32,
     convert_to_fused_conv_bn_model,
     get_actual_survival_probabilities,
+    get_convert_gelu_and_extract_patches_for_tflite_clone_function,
+    get_convert_groups_conv2d_2_split_conv2d_clone_function,
+    get_convert_mixed_float16_to_float32_clone_function,
+    get_convert_to_mixed_float16_clone_function,
+    get_replace_ReLU_clone_function,
     get_actual_drop_connect_rates,
     get_pyramide_feture_layers,
     prepare_for_tflite,
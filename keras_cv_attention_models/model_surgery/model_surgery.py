@@ -1,3 +1,4 @@
+import functools
 import tensorflow as tf
 from tensorflow import keras
 import tensorflow.keras.backend as K
@@ -9,12 +10,19 @@ class SAMModel(keras.models.Model):
     Implementation by: [Keras SAM (Sharpness-Aware Minimization)](https://qiita.com/T-STAR/items/8c3afe3a116a8fc08429)
 
     Usage is same with `keras.modeols.Model`: `model = SAMModel(inputs, outputs, rho=sam_rho, name=name)`
+    `compile` defaults `jit_compile=True`, set `model.compile(..., jit_compile=False)` if any op is not supported by XLA.
     """
 
     def __init__(self, *args, rho=0.05, **kwargs):
         super().__init__(*args, **kwargs)
         self.rho = tf.constant(rho, dtype=tf.float32)
 
+    def compile(self, *args, jit_compile=True, **kwargs):
+        # XLA fuses the weight perturb / restore with the two forward and backward passes in train_step
+        super().compile(*args, **kwargs)
+        if hasattr(self, "jit_compile"):  # Not supported in early TF versions. Will fallback to False if TF not built with XLA
+            self.jit_compile = jit_compile
+
     def train_step(self, data):
         if len(data) == 3:
             x, y, sample_weight = data
@@ -32,18 +40,17 @@ class SAMModel(keras.models.Model):
 
         norm = tf.linalg.global_norm(gradients)
         scale = self.rho / (norm + 1e-12)
-        e_w_list = []
-        for v, grad in zip(trainable_vars, gradients):
-            e_w = grad * scale
+        # Skip variables without gradient. Restoring uses exact assign_sub, not optimizer.apply_gradients, which rescales updates
+        perturbs = [(v, grad * scale) for v, grad in zip(trainable_vars, gradients) if grad is not None]
+        for v, e_w in perturbs:
             v.assign_add(e_w)
-            e_w_list.append(e_w)
 
         # 2nd step
         with tf.GradientTape() as tape:
             y_pred_adv = self(x, training=True)
             loss_adv = self.compiled_loss(y, y_pred_adv, sample_weight=sample_weight, regularization_losses=self.losses)
         gradients_adv = tape.gradient(loss_adv, trainable_vars)
-        for v, e_w in zip(trainable_vars, e_w_list):
+        for v, e_w in perturbs:
             v.assign_sub(e_w)
 
         # optimize
@@ -97,6 +104,7 @@ def add_l2_regularizer_2_model(model, weight_decay, custom_objects={}, apply_to_
                     regularizers_type[layer.__class__.__name__] = rrs
         print(regularizers_type)
 
+    layer_attrs = {}
     for layer in model.layers:
         attrs = []
         if isinstance(layer, keras.layers.Dense) or isinstance(layer, keras.layers.Conv2D):
@@ -124,22 +132,56 @@ def add_l2_regularizer_2_model(model, weight_decay, custom_objects={}, apply_to_
             # print(">>>> PReLU", layer.name)
             attrs = ["alpha_regularizer"]
 
-        for attr in attrs:
-            if hasattr(layer, attr) and layer.trainable:
-                setattr(layer, attr, keras.regularizers.L2(weight_decay / 2))
+        attrs = [attr for attr in attrs if hasattr(layer, attr) and layer.trainable]
+        if len(attrs) != 0:
+            layer_attrs[layer.name] = attrs
+
+    has_previous_regularizer = any([getattr(model.get_layer(kk), attr) is not None for kk, vv in layer_attrs.items() for attr in vv])
+    if has_previous_regularizer:
+        # Previous regularizer losses are already registered in layers, clone a new model with only new ones, leaving input model untouched.
+        # temp_weight_file = "tmp_weights.h5"
+        # model.save_weights(temp_weight_file)
+        # out_model = keras.models.model_from_json(model.to_json(), custom_objects=custom_objects)
+        # out_model.load_weights(temp_weight_file, by_name=True)
+        # os.remove(temp_weight_file)
+        # return out_model
+        def set_regularizer_clone_function(layer):
+            config = layer.get_config()
+            config.update({attr: keras.regularizers.L2(weight_decay / 2) for attr in layer_attrs.get(layer.name, [])})
+            return layer.__class__.from_config(config)
+
+        out_model = keras.models.clone_model(model, clone_function=set_regularizer_clone_function)
+        out_model.set_weights(model.get_weights())  # clone_model re-initializes weights
+        return out_model
 
-    # So far, the regularizers only exist in the model config. We need to
-    # reload the model so that Keras adds them to each layer's losses.
-    # temp_weight_file = "tmp_weights.h5"
-    # model.save_weights(temp_weight_file)
-    # out_model = keras.models.model_from_json(model.to_json(), custom_objects=custom_objects)
-    # out_model.load_weights(temp_weight_file, by_name=True)
-    # os.remove(temp_weight_file)
-    # return out_model
-    return keras.models.clone_model(model)
+    for layer in model.layers:
+        for attr in layer_attrs.get(layer.name, []):
+            regularizer = keras.regularizers.L2(weight_decay / 2)
+            setattr(layer, attr, regularizer)
+            # Register loss on the built layer directly, same as keras `_handle_weight_regularization`. Avoids cloning the whole model
+            weight_name = attr.replace("_regularizer", "_kernel" if attr in ["depthwise_regularizer", "pointwise_regularizer"] else "")
+            layer.add_loss(functools.partial(regularizer, getattr(layer, weight_name)))
+    return model
 
 
-def replace_ReLU(model, target_activation="PReLU", **kwargs):
+def apply_surgeries(model, *clone_functions):
+    """
+    Apply multiple `clone_function`s in a single `keras.models.clone_model` pass, instead of cloning the model once for each.
+    Each layer goes through `clone_functions` in order, output of the previous one is the input of the next one.
+
+    Exampls:
+    >>> from keras_cv_attention_models import model_surgery
+    >>> mm = keras.applications.ResNet50()
+    >>> mm = model_surgery.apply_surgeries(
+    >>>     mm, model_surgery.get_replace_ReLU_clone_function("PReLU"), model_surgery.get_convert_to_mixed_float16_clone_function()
+    >>> )
+    """
+    clone_function = lambda layer: functools.reduce(lambda xx, func: func(xx), clone_functions, layer)
+    input_tensors = keras.layers.Input(model.input_shape[1:])
+    return keras.models.clone_model(model, input_tensors=input_tensors, clone_function=clone_function)
+
+
+def get_replace_ReLU_clone_function(target_activation="PReLU", **kwargs):
     from tensorflow.keras.layers import ReLU, PReLU, Activation
 
     def convert_ReLU(layer):
@@ -161,8 +203,11 @@ def replace_ReLU(model, target_activation="PReLU", **kwargs):
                 return target_activation(**kwargs)
         return layer
 
-    input_tensors = keras.layers.Input(model.input_shape[1:])
-    return keras.models.clone_model(model, input_tensors=input_tensors, clone_function=convert_ReLU)
+    return convert_ReLU
+
+
+def replace_ReLU(model, target_activation="PReLU", **kwargs):
+    return apply_surgeries(model, get_replace_ReLU_clone_function(target_activation, **kwargs))
 
 
 def change_model_input_shape(model, new_input_shape):
@@ -293,8 +338,8 @@ def get_pyramide_feture_layers(model, match_reg="^stack_?(\\d+).*output.*$"):
     return list(ee.values())
 
 
-def convert_to_mixed_float16(model, convert_batch_norm=False):
-    policy = keras.mixed_precision.Policy("mixed_float16")
+def get_convert_to_mixed_float16_clone_function(convert_batch_norm=False, policy="mixed_float16"):
+    policy = keras.mixed_precision.Policy(policy)
     policy_config = keras.utils.serialize_keras_object(policy)
     from tensorflow.keras.layers import InputLayer, Activation
     from tensorflow.keras.activations import linear
@@ -306,16 +351,21 @@ def convert_to_mixed_float16(model, convert_batch_norm=False):
             aa = layer.get_config()
             aa.update({"dtype": policy_config})
             bb = layer.__class__.from_config(aa)
-            bb.build(layer.input_shape)
-            bb.set_weights(layer.get_weights())
+            if layer.built:  # Layer may be a new one created by previous clone_function in apply_surgeries
+                bb.build(layer.input_shape)
+                bb.set_weights(layer.get_weights())
             return bb
         return layer
 
-    input_tensors = keras.layers.Input(model.input_shape[1:])
-    return keras.models.clone_model(model, input_tensors=input_tensors, clone_function=do_convert_to_mixed_float16)
+    return do_convert_to_mixed_float16
 
 
-def convert_mixed_float16_to_float32(model):
+def convert_to_mixed_float16(model, convert_batch_norm=False, policy="mixed_float16"):
+    """ policy: one of `"mixed_float16"` or `"mixed_bfloat16"`, `mixed_bfloat16` is recommended for TPU / Ampere+ GPUs. """
+    return apply_surgeries(model, get_convert_to_mixed_float16_clone_function(convert_batch_norm, policy))
+
+
+def get_convert_mixed_float16_to_float32_clone_function():
     from tensorflow.keras.layers import InputLayer, Activation
     from tensorflow.keras.activations import linear
 
@@ -324,30 +374,84 @@ def convert_mixed_float16_to_float32(model):
             aa = layer.get_config()
             aa.update({"dtype": "float32"})
             bb = layer.__class__.from_config(aa)
-            bb.build(layer.input_shape)
-            bb.set_weights(layer.get_weights())
+            if layer.built:
+                bb.build(layer.input_shape)
+                bb.set_weights(layer.get_weights())
             return bb
         return layer
 
-    input_tensors = keras.layers.Input(model.input_shape[1:])
-    return keras.models.clone_model(model, input_tensors=input_tensors, clone_function=do_convert_to_mixed_float16)
+    return do_convert_to_mixed_float16
+
+
+def convert_mixed_float16_to_float32(model):
+    return apply_surgeries(model, get_convert_mixed_float16_to_float32_clone_function())
+
+
+def fuse_bn_dense(bn_layer, dense_layer):
+    # Batchnorm before Dense: dense_w_new = gamma / sqrt(var + epsilon) * dense_w, per input channel
+    # --> dense_b_new = dense_b + (beta - gamma * mean / sqrt(var + epsilon)) @ dense_w
+    batch_std = tf.sqrt(bn_layer.moving_variance + bn_layer.epsilon)
+    scale = (bn_layer.gamma if bn_layer.scale else 1.0) / batch_std
+    shift = (bn_layer.beta if bn_layer.center else 0.0) - bn_layer.moving_mean * scale
+    ww = dense_layer.kernel * tf.expand_dims(scale, -1)
+    bias = tf.tensordot(shift, dense_layer.kernel, axes=1)
+    if dense_layer.use_bias:
+        bias += dense_layer.bias
+
+    cc = dense_layer.get_config()
+    cc["use_bias"] = True
+    fused_bn_dense = dense_layer.__class__.from_config(cc)
+    fused_bn_dense.build(dense_layer.input_shape)
+    fused_bn_dense.set_weights([ww, bias])
+    return fused_bn_dense
+
+
+def convert_to_int8_tflite(model, representative_dataset, fuse_bn=True):
+    """
+    Post-training full integer quantization using `tf.lite.TFLiteConverter`, returns the converted TFLite model bytes.
+    Model inputs / outputs are also int8. Ops not supporting int8 will fail the conversion.
+
+    Args:
+      model: float32 keras model.
+      representative_dataset: a callable returning a generator, each time yields a list of input samples,
+          like `lambda: ([tf.random.uniform([1, *model.input_shape[1:]])] for _ in range(100))`.
+      fuse_bn: boolean value if fusing `Conv2D` / `DepthwiseConv2D` / `Dense` and batchnorm layers before converting.
+
+    Exampls:
+    >>> from keras_cv_attention_models import model_surgery
+    >>> mm = keras.applications.MobileNetV2()
+    >>> representative_dataset = lambda: ([tf.random.uniform([1, *mm.input_shape[1:]])] for _ in range(100))
+    >>> open(mm.name + "_int8.tflite", "wb").write(model_surgery.convert_to_int8_tflite(mm, representative_dataset))
+    """
+    if fuse_bn:
+        model = convert_to_fused_conv_bn_model(model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    return converter.convert()
 
 
 def fuse_conv_bn(conv_layer, bn_layer):
     # BatchNormalization returns: gamma * (batch - self.moving_mean) / sqrt(self.moving_var + epsilon) + beta
     # --> conv_w_new = gamma * conv_w / np.sqrt(var + epsilon)
     # --> conv_b_new = gamma * (conv_b - mean) / sqrt(var + epsilon) + beta
+    # Also works for Dense, as kernel output channel is also the last dimension
     batch_std = tf.sqrt(bn_layer.moving_variance + bn_layer.epsilon)
+    gamma = bn_layer.gamma if bn_layer.scale else 1.0
+    beta = bn_layer.beta if bn_layer.center else 0.0
     if isinstance(conv_layer, keras.layers.DepthwiseConv2D):
-        ww = tf.transpose(conv_layer.depthwise_kernel, [0, 1, 3, 2]) * bn_layer.gamma / batch_std
+        ww = tf.transpose(conv_layer.depthwise_kernel, [0, 1, 3, 2]) * gamma / batch_std
         ww = tf.transpose(ww, [0, 1, 3, 2])
     else:
-        ww = conv_layer.kernel * bn_layer.gamma / batch_std
+        ww = conv_layer.kernel * gamma / batch_std
 
     if conv_layer.use_bias:
-        bias = bn_layer.gamma * (conv_layer.bias - bn_layer.moving_mean) / batch_std + bn_layer.beta
+        bias = gamma * (conv_layer.bias - bn_layer.moving_mean) / batch_std + beta
     else:
-        bias = bn_layer.gamma * (-1 * bn_layer.moving_mean) / batch_std + bn_layer.beta
+        bias = gamma * (-1 * bn_layer.moving_mean) / batch_std + beta
 
     cc = conv_layer.get_config()
     cc["use_bias"] = True
@@ -359,7 +463,8 @@ def fuse_conv_bn(conv_layer, bn_layer):
 
 def convert_to_fused_conv_bn_model(model):
     """
-    Convert model by fusing Conv + batchnorm
+    Convert model by fusing Conv / Dense + batchnorm, and batchnorm + Dense like classifier heads in LeViT, for inference only.
+    Only fuse batchnorm on the last axis, and the Conv / Dense / batchnorm output is not used by other layers.
 
     Exampls:
     >>> from keras_cv_attention_models import model_surgery
@@ -372,26 +477,46 @@ def convert_to_fused_conv_bn_model(model):
     model_config = json.loads(model.to_json())
     ee = {layer["name"]: layer for layer in model_config["config"]["layers"]}
     fuse_convs, fuse_bns = [], []
-    conv_names = ["Conv2D", "DepthwiseConv2D"]
+    conv_names = ["Conv2D", "DepthwiseConv2D", "Dense"]
+    is_last_axis = lambda layer: model.get_layer(layer["name"]).axis in [[-1], [len(model.get_layer(layer["name"]).input_shape) - 1]]
+    is_single_output = lambda name: len(model.get_layer(name).outbound_nodes) == 1
     for layer in model_config["config"]["layers"]:
-        if layer["class_name"] == "BatchNormalization" and len(layer["inbound_nodes"]) == 1:
+        if layer["class_name"] == "BatchNormalization" and len(layer["inbound_nodes"]) == 1 and is_last_axis(layer):
             input_node = layer["inbound_nodes"][0][0]
-            if isinstance(input_node, list) and ee.get(input_node[0], {"class_name": None})["class_name"] in conv_names:
+            if isinstance(input_node, list) and ee.get(input_node[0], {"class_name": None})["class_name"] in conv_names and is_single_output(input_node[0]):
                 fuse_convs.append(input_node[0])
                 fuse_bns.append(layer["name"])
     print(">>>> len(fuse_convs) =", len(fuse_convs), "len(fuse_bns) =", len(fuse_bns))
     # len(fuse_convs) = 53, len(fuse_bns) = 53
 
+    """ Check Dense layers with bn layer input, not already fused with a previous conv """
+    pre_fuse_bns, pre_fuse_denses = [], []
+    for layer in model_config["config"]["layers"]:
+        if layer["class_name"] == "Dense" and layer["name"] not in fuse_convs and len(layer["inbound_nodes"]) == 1:
+            input_node = layer["inbound_nodes"][0][0]
+            input_layer = ee.get(input_node[0], {"class_name": None}) if isinstance(input_node, list) else {"class_name": None}
+            if input_layer["class_name"] == "BatchNormalization" and input_layer["name"] not in fuse_bns and len(input_layer["inbound_nodes"]) == 1:
+                if is_last_axis(input_layer) and is_single_output(input_layer["name"]):
+                    pre_fuse_bns.append(input_layer["name"])
+                    pre_fuse_denses.append(layer["name"])
+    print(">>>> len(pre_fuse_bns) =", len(pre_fuse_bns), "len(pre_fuse_denses) =", len(pre_fuse_denses))
+
     """ Create new model config """
     layers = []
     fused_bn_dict = dict(zip(fuse_bns, fuse_convs))
     fused_conv_dict = dict(zip(fuse_convs, fuse_bns))
+    pre_fused_dense_dict = dict(zip(pre_fuse_denses, pre_fuse_bns))
     is_inbound_elem = lambda xx: isinstance(xx, list) and isinstance(xx[0], str)
     for layer in model_config["config"]["layers"]:
         if layer["name"] in fuse_convs:
             print(">>>> Fuse conv bn:", layer["name"])
             layer["config"]["use_bias"] = True
-        elif layer["name"] in fuse_bns:
+        elif layer["name"] in pre_fused_dense_dict:
+            print(">>>> Fuse bn dense:", layer["name"])
+            layer["config"]["use_bias"] = True
+            # Connect Dense to the bn input directly
+            layer["inbound_nodes"][0][0][:3] = ee[pre_fused_dense_dict[layer["name"]]]["inbound_nodes"][0][0][:3]
+        elif layer["name"] in fuse_bns or layer["name"] in pre_fuse_bns:
             continue
 
         for ii in layer["inbound_nodes"]:
@@ -411,7 +536,7 @@ def convert_to_fused_conv_bn_model(model):
 
     """ New model set layer weights by layer names """
     for layer in new_model.layers:
-        if layer.name in fuse_bns:  # This should not happen
+        if layer.name in fuse_bns or layer.name in pre_fuse_bns:  # This should not happen
             continue
 
         orign_layer = model.get_layer(layer.name)
@@ -420,6 +545,11 @@ def convert_to_fused_conv_bn_model(model):
             print(">>>> Fuse conv bn", layer.name, orign_bn_layer.name)
             conv_bn = fuse_conv_bn(orign_layer, orign_bn_layer)
             layer.set_weights(conv_bn.get_weights())
+        elif layer.name in pre_fused_dense_dict:
+            orign_bn_layer = model.get_layer(pre_fused_dense_dict[layer.name])
+            print(">>>> Fuse bn dense", orign_bn_layer.name, layer.name)
+            bn_dense = fuse_bn_dense(orign_bn_layer, orign_layer)
+            layer.set_weights(bn_dense.get_weights())
         else:
             layer.set_weights(orign_layer.get_weights())
     return new_model
@@ -463,7 +593,7 @@ class SplitScaledStandardizedConv2D(SplitConv2D):
         return base_config
 
 
-def convert_groups_conv2d_2_split_conv2d(model):
+def get_convert_groups_conv2d_2_split_conv2d_clone_function():
     from tensorflow.keras.layers import Conv2D
 
     def __convert_groups_conv2d_2_split_conv2d__(layer):
@@ -489,11 +619,14 @@ def convert_groups_conv2d_2_split_conv2d(model):
             return bb
         return layer
 
-    input_tensors = keras.layers.Input(model.input_shape[1:])
-    return keras.models.clone_model(model, input_tensors=input_tensors, clone_function=__convert_groups_conv2d_2_split_conv2d__)
+    return __convert_groups_conv2d_2_split_conv2d__
 
 
-def convert_gelu_and_extract_patches_for_tflite(model):
+def convert_groups_conv2d_2_split_conv2d(model):
+    return apply_surgeries(model, get_convert_groups_conv2d_2_split_conv2d_clone_function())
+
+
+def get_convert_gelu_and_extract_patches_for_tflite_clone_function():
     from keras_cv_attention_models import attention_layers
 
     def __convert_gelu_and_extract_patches_for_tflite__(layer):
@@ -507,11 +640,14 @@ def convert_gelu_and_extract_patches_for_tflite(model):
             return bb
         return layer
 
-    input_tensors = keras.layers.Input(model.input_shape[1:])
-    return keras.models.clone_model(model, input_tensors=input_tensors, clone_function=__convert_gelu_and_extract_patches_for_tflite__)
+    return __convert_gelu_and_extract_patches_for_tflite__
+
+
+def convert_gelu_and_extract_patches_for_tflite(model):
+    return apply_surgeries(model, get_convert_gelu_and_extract_patches_for_tflite_clone_function())
 
 
 def prepare_for_tflite(model):
-    model = convert_groups_conv2d_2_split_conv2d(model)
-    model = convert_gelu_and_extract_patches_for_tflite(model)
-    return model
+    return apply_surgeries(
+        model, get_convert_groups_conv2d_2_split_conv2d_clone_function(), get_convert_gelu_and_extract_patches_for_tflite_clone_function()
+    )
@@ -154,6 +154,31 @@ def test_MultiHeadPositionalEmbedding():
     assert aa(tf.ones(input_shape)).shape == input_shape
 
 
+@pytest.mark.parametrize("dtype", ["float32", "mixed_float16"])
+def test_MultiHeadPositionalEmbedding_cache_pos_bias(dtype):
+    aa = attention_layers.MultiHeadPositionalEmbedding(dtype=dtype)
+    inputs = tf.random.uniform([2, 8, 16, 49])
+    aa(inputs)
+    aa.cache_pos_bias()
+    aa.set_weights([tf.random.uniform(aa.bb.shape)])  # Layer set_weights refreshes cache
+
+    out, expected = aa(inputs), aa(inputs, training=True)  # training=True not using cache
+    assert out.dtype == expected.dtype
+    assert tf.reduce_max(tf.abs(tf.cast(out, "float32") - tf.cast(expected, "float32"))) < 1e-6
+
+
+@pytest.mark.parametrize("method", ["nearest", "bilinear"])
+def test_MultiHeadPositionalEmbedding_resize_matrix_1d(method):
+    from keras_cv_attention_models.levit.levit import resize_matrix_1d
+
+    for source_size in range(2, 40):
+        inputs = tf.random.uniform([source_size, 1, 1])
+        for target_size in range(2, 40):
+            expected = tf.image.resize(inputs, [target_size, 1], method=method)[:, 0, 0]
+            out = resize_matrix_1d(source_size, target_size, method) @ inputs[:, 0, 0].numpy()
+            assert tf.reduce_max(tf.abs(out - expected)) < 1e-5, (source_size, target_size)
+
+
 def test_MultiHeadRelativePositionalEmbedding():
     aa = attention_layers.MultiHeadRelativePositionalEmbedding()
     input_shape = [2, 8, 29 * 29 + 1, 29 * 29 + 1]
@@ -88,6 +88,19 @@ def test_LeViT_defination():
     assert isinstance(mm, keras.models.Model)
 
 
+@pytest.mark.parametrize("policy", ["mixed_float16", "mixed_bfloat16"])
+def test_LeViT_convert_to_mixed_float16(policy):
+    mm = keras_cv_attention_models.levit.LeViT128S(pretrained=None)
+    inputs = mm.preprocess_input(chelsea())
+    mm = keras_cv_attention_models.model_surgery.convert_to_mixed_float16(mm, policy=policy)
+    pred = mm(inputs)
+    assert pred[0].shape == (1, 1000)
+
+    matmul_layers = [ii for ii in mm.layers if ii.name.endswith("_matmul")]
+    assert len(matmul_layers) > 0
+    assert all([ii.compute_dtype == policy.split("_")[-1] for ii in matmul_layers])
+
+
 def test_MLPMixer_defination():
     mm = keras_cv_attention_models.mlp_family.MLPMixerB16(pretrained=None)
     assert isinstance(mm, keras.models.Model)